@@ -1,17 +1,20 @@
 #! python
 import chevron
-import collections
 import ffmpeg
+import gzip
+import itertools
 import math
+import numpy as np
+import os
 import re
 import srt
-import struct
 
 INPUT_PATH = 'rickroll.mp4'
 PROOF_PATH = 'proof.mp4'
 DICT_PATTERN_PATH = 'dict.txt'
 ITEM_ASSEMBLY_TEMPLATE = 'oled.mustache'
 SUBTITLE_PATH = 'rickroll.srt'
+COMPRESS_OUTPUT = False
 
 # WIDTH = 32
 # HEIGHT = 18
@@ -27,10 +30,13 @@ REGEX_X_OFFSET = -192
 REGEX_Y_OFFSET = 103
 RESERVED_REGEX_CHARS = '.+*?^$()[]{}|\\'
 RESERVED_XML_CHARS = '<>&"\''
+STREAMED_FIELDS = ('vid_data',)
+WRITE_CHUNK_SIZE = 1 << 20
 
 ALPHABET = [chr(i) for i in range(32, 127) if chr(i) not in RESERVED_XML_CHARS]
 BUFFER_SIZE = FRAMERATE * WIDTH * HEIGHT * 60
 FRAME_SIZE = WIDTH * HEIGHT
+DEFAULT_FRAME_COUNT = FRAMERATE * 60
 
 template = {
     'filename': 'oled_%s' % (re.match('^(.*)\\..{3}$', INPUT_PATH).group(1),),
@@ -55,42 +61,39 @@ wires = []
 
 
 class Node:
-    def __init__(self, comp, name):
+    __slots__ = ('comp', 'wire_id', 'x_coord', 'y_coord')
+
+    def __init__(self, comp):
         self.comp = comp
-        self.name = name
         self.wire_id = None
-
-    def x_coord(self):
-        return self.comp.x_coord + self.comp.comp_width / 2
-
-    def y_coord(self):
-        return self.comp.y_coord - self.comp.comp_height / 2
+        self.x_coord = comp.x_coord + comp.comp_width / 2
+        self.y_coord = comp.y_coord - comp.comp_height / 2
 
     def template(self):
         return {'id': self.wire_id} if self.wire_id is not None else None
 
 
 class Wire:
+    __slots__ = ('node_start', 'node_end', 'id')
+
     def __init__(self, node_start, node_end):
         self.node_start = node_start
         self.node_end = node_end
         self.id = None
 
     def template(self):
+        sx, sy = self.node_start.x_coord, self.node_start.y_coord
+        ex, ey = self.node_end.x_coord, self.node_end.y_coord
         return {
             'id': self.id,
-            'rectxy': '{},{}'.format(
-                (self.node_start.x_coord() + self.node_end.x_coord()) / 2,
-                (self.node_start.y_coord() + self.node_end.y_coord()) / 2),
-            'nodes': '{};{};{};{}'.format(
-                self.node_start.x_coord(),
-                self.node_start.y_coord(),
-                self.node_end.x_coord(),
-                self.node_end.y_coord()),
+            'rectxy': f'{(sx + ex) / 2},{(sy + ey) / 2}',
+            'nodes': f'{sx};{sy};{ex};{ey}',
         }
 
 
 class Component:
+    __slots__ = ('x_coord', 'y_coord', 'comp_width', 'comp_height', 'id')
+
     def __init__(self, x_coord, y_coord, comp_width, comp_height):
         self.x_coord = x_coord
         self.y_coord = y_coord
@@ -98,8 +101,8 @@ class Component:
         self.comp_height = comp_height
         self.id = None
 
-    def node(self, name):
-        return Node(self, name)
+    def node(self):
+        return Node(self)
 
     def template_data(self):
         return {
@@ -109,21 +112,25 @@ class Component:
 
 
 class Concat(Component):
+    __slots__ = ('signal_out',)
+
     def __init__(self):
         super().__init__(-224, 71, 15, 14)
-        self.signal_out = [self.node('signal_out') for _ in range(5)]
+        self.signal_out = [self.node() for _ in range(5)]
 
     def template(self):
         return [out.template() for out in self.signal_out]
 
 
 class Relay(Component):
+    __slots__ = ('signal_in1', 'signal_in2', 'signal_out1', 'signal_out2')
+
     def __init__(self):
         super().__init__(-207, 88, 15, 13)
-        self.signal_in1 = self.node('signal_in1')
-        self.signal_in2 = self.node('signal_in2')
-        self.signal_out1 = [self.node('signal_out1') for _ in range(5)]
-        self.signal_out2 = [self.node('signal_out2') for _ in range(5)]
+        self.signal_in1 = self.node()
+        self.signal_in2 = self.node()
+        self.signal_out1 = [self.node() for _ in range(5)]
+        self.signal_out2 = [self.node() for _ in range(5)]
 
     def template(self):
         template = super().template_data()
@@ -141,25 +148,24 @@ class Relay(Component):
 
 
 class RegEx(Component):
+    __slots__ = ('px_offset', 'lib_offset', 'signal_in', 'signal_out')
+
     def __init__(self, x, y):
         super().__init__(
             REGEX_X_OFFSET + x * 16,
             REGEX_Y_OFFSET + (HEIGHT - 1 - y) * 16,
             15,
             13)
-        self.x = x
-        self.y = y
-        self.signal_in = self.node('signal_in')
-        self.signal_out = self.node('signal_out')
+        self.px_offset = x + y * WIDTH
+        self.lib_offset = FRAME_SIZE - self.px_offset - 1
+        self.signal_in = self.node()
+        self.signal_out = self.node()
 
     def pattern(self):
-        px_offset = self.x + self.y * WIDTH
-        lib_offset = WIDTH * HEIGHT - px_offset - 1
-        return ('^'
-                + ('' if px_offset == 0 else '(?:.{%s})' % px_offset)
-                + '(?<px>.)'
-                + ('' if lib_offset == 0 else '(?:.{%s})' % lib_offset)
-                + '(?:.{8})*?\\k<px>(?<out>.{7})')
+        px_skip = f'(?:.{{{self.px_offset}}})' if self.px_offset else ''
+        lib_skip = f'(?:.{{{self.lib_offset}}})' if self.lib_offset else ''
+        return (f'^{px_skip}(?<px>.){lib_skip}'
+                f'(?:.{{8}})*?\\k<px>(?<out>.{{7}})')
 
     def template(self):
         template = super().template_data()
@@ -170,13 +176,15 @@ class RegEx(Component):
 
 
 class Light(Component):
+    __slots__ = ('set_color',)
+
     def __init__(self, x, y):
         super().__init__(
             LIGHT_X_OFFSET + x * 16,
             LIGHT_Y_OFFSET + (HEIGHT - 1 - y) * 16,
             16,
             16)
-        self.set_color = self.node('set_color')
+        self.set_color = self.node()
 
     def template(self):
         template = super().template_data()
@@ -201,104 +209,177 @@ paletteuse = ffmpeg.filter(
     [input_streams[1].filter('fifo'), palettegen],
     filter_name='paletteuse',
     dither='floyd_steinberg'
-).split()
-
-output = ffmpeg.merge_outputs(
-    paletteuse[0].output('pipe:', format='rawvideo', pix_fmt='rgb24'),
-    paletteuse[1].output(
-        PROOF_PATH,
-        vcodec='libx264',
-        preset='veryslow',
-        crf=0)
-).overwrite_output()
-
-print(output.compile())
-rgb_raw, _ = output.run(capture_stdout=True)
-
-print('> Generating character mapping')
-data = struct.iter_unpack('BBB', rgb_raw)
-px_dict = dict(
-    zip([px for px, _ in collections.Counter(data).most_common()], ALPHABET))
-
-print('> Writing video data')
-template['vid_data'] = ''.join(
-    [px_dict[px] for px in struct.iter_unpack('BBB', rgb_raw)]) + '&'
-template['vid_data_length'] = len(template['vid_data'])
-assert len(template['vid_data']) <= (MAX_FRAMES * WIDTH * HEIGHT)
-
-print('> Writing dictionary')
-template['px_lib'] = ''.join(
-    [char
-        + '#'
-        + ''.join(['{:02x}'.format(byte) for byte in px])
-        for px, char in px_dict.items()]
 )
-template['px_lib_length'] = len(template['px_lib'])
-
-if SUBTITLE_PATH is not None:
-    print('> Parsing subtitles')
-    with open(SUBTITLE_PATH, 'r+') as f:
-        subtitle_data = srt.parse(f.read(), ignore_errors=True)
-    template['caption_data'] = '~' + ''.join(['%d %s~' % (
-        math.floor(subtitle.start.total_seconds() * FRAMERATE),
-        text
-    )
-        for subtitle in subtitle_data
-        for text in subtitle.content.replace('~', '-').split('\n')
-    ])
-    template['caption_data_length'] = len(template['caption_data'])
-
-
-print('> Generating components and wiring')
-
-concat = Concat()
-out_nodes = collections.deque(concat.signal_out)
-
-while len(out_nodes) < WIDTH * HEIGHT:
-    relay = Relay()
-    wires.append(Wire(out_nodes.popleft(), relay.signal_in1))
-    out_nodes.extend(relay.signal_out1)
-    if len(out_nodes) < WIDTH * HEIGHT:
-        wires.append(Wire(out_nodes.popleft(), relay.signal_in2))
-        out_nodes.extend(relay.signal_out2)
-    relays.append(relay)
-
-for y in range(HEIGHT):
-    for x in range(WIDTH):
-        regex = RegEx(x, y)
-        light = Light(x, y)
-        wires.append(Wire(out_nodes.popleft(), regex.signal_in))
-        wires.append(Wire(regex.signal_out, light.set_color))
-        regexs.append(regex)
-        lights.append(light)
-
-
-for i in range(len(relays)):
-    relays[i].id = COMPONENT_ID_OFFSET + i
-
-for i in range(len(regexs)):
-    regexs[i].id = COMPONENT_ID_OFFSET + len(relays) + i
-
-for i in range(len(lights)):
-    lights[i].id = COMPONENT_ID_OFFSET + len(relays) + len(regexs) + i
-
-offset_id = COMPONENT_ID_OFFSET + len(relays) + len(regexs) + len(lights)
-for i in range(len(wires)):
-    wires[i].id = offset_id + i
-    wires[i].node_start.wire_id = wires[i].id
-    wires[i].node_end.wire_id = wires[i].id
-
-template['concat_length'] = \
-    template['frame_length'] + template['px_lib_length']
-template['concat_out'] = concat.template()
-template['relay_comp'] = [relay.template() for relay in relays]
-template['regex_comp'] = [regex.template() for regex in regexs]
-template['light_comp'] = [light.template() for light in lights]
-template['wire'] = [wire.template() for wire in wires]
-
-print('> Writing item assembly')
-with open('build/%s.xml' % template['filename'], 'w') as f_out:
+
+# the rgb dump and the proof encode run side by side, so split the cores
+# between them and keep both off the shared terminal's stdin
+filter_threads = str(max(1, (os.cpu_count() or 1) // 2))
+global_args = ('-nostdin',
+               '-filter_threads', filter_threads,
+               '-filter_complex_threads', filter_threads)
+rgb_output = (
+    paletteuse.output('pipe:', format='rawvideo', pix_fmt='rgb24')
+              .global_args(*global_args)
+)
+proof_output = (
+    paletteuse.output(PROOF_PATH, vcodec='libx264', preset='veryslow', crf=0)
+              .global_args(*global_args)
+              .overwrite_output()
+)
+
+# only a sizing hint, the read loop grows the buffer if it falls short
+try:
+    n_frames = math.ceil(
+        float(ffmpeg.probe(INPUT_PATH)['format']['duration'])
+        * FRAMERATE) + 1
+except (ffmpeg.Error, OSError, KeyError, ValueError):
+    n_frames = DEFAULT_FRAME_COUNT
+
+print(rgb_output.compile())
+print(proof_output.compile())
+proof_proc = proof_output.run_async()
+# don't leave the proof encode running if anything below fails
+try:
+    rgb_proc = rgb_output.run_async(pipe_stdout=True)
+
+    rgb_frames = np.empty((n_frames, HEIGHT, WIDTH, 3), dtype=np.uint8)
+    rgb_view = memoryview(rgb_frames).cast('B')
+    rgb_length = 0
+    while True:
+        if rgb_length == len(rgb_view):
+            rgb_frames = np.concatenate(
+                (rgb_frames, np.empty_like(rgb_frames)))
+            rgb_view = memoryview(rgb_frames).cast('B')
+        n_read = rgb_proc.stdout.readinto(
+            rgb_view[rgb_length:rgb_length + FRAME_SIZE * 3])
+        if not n_read:
+            break
+        rgb_length += n_read
+    if rgb_proc.wait():
+        raise ffmpeg.Error('ffmpeg', None, None)
+
+    print('> Generating character mapping')
+    rgb = rgb_frames.reshape(-1, 3)[:rgb_length // 3]
+    pix_packed = ((rgb[:, 0].astype(np.uint32) << 16)
+                  | (rgb[:, 1].astype(np.uint32) << 8)
+                  | rgb[:, 2])
+    # palettegen already limits the stream to len(ALPHABET) colours, counts are
+    # only kept so the most common colours sit at the front of the library
+    px_vals, px_counts = np.unique(pix_packed, return_counts=True)
+    assert len(px_vals) <= len(ALPHABET)
+    px_order = np.argsort(-px_counts, kind='stable')
+    px_dict = dict(zip(px_vals[px_order].tolist(), ALPHABET))
+
+    print('> Writing video data')
+    # 0 is never a palette character, so it marks colours missing from px_dict
+    px_lut = np.zeros(1 << 24, dtype=np.uint8)
+    for px, char in px_dict.items():
+        px_lut[px] = ord(char)
+    vid_codes = px_lut[pix_packed]
+    if not vid_codes.all():
+        raise ValueError('video contains colours missing from the palette')
+    template['vid_data'] = vid_codes.tobytes() + b'&'
+    template['vid_data_length'] = len(template['vid_data'])
+    assert len(template['vid_data']) <= (MAX_FRAMES * WIDTH * HEIGHT)
+
+    print('> Writing dictionary')
+    template['px_lib'] = ''.join(
+        [f'{char}#{px:06x}' for px, char in px_dict.items()])
+    template['px_lib_length'] = len(template['px_lib'])
+
+    if SUBTITLE_PATH is not None:
+        print('> Parsing subtitles')
+        with open(SUBTITLE_PATH, 'r+') as f:
+            subtitle_data = srt.parse(f.read(), ignore_errors=True)
+        caption_parts = []
+        for subtitle in subtitle_data:
+            frame = math.floor(subtitle.start.total_seconds() * FRAMERATE)
+            for text in subtitle.content.replace('~', '-').split('\n'):
+                caption_parts.append(f'{frame} {text}')
+        template['caption_data'] = '~'.join(['', *caption_parts, ''])
+        template['caption_data_length'] = len(template['caption_data'])
+
+    print('> Generating components and wiring')
+
+    concat = Concat()
+    out_nodes = list(concat.signal_out)
+    head = 0
+
+    while len(out_nodes) - head < WIDTH * HEIGHT:
+        relay = Relay()
+        wires.append(Wire(out_nodes[head], relay.signal_in1))
+        head += 1
+        out_nodes.extend(relay.signal_out1)
+        if len(out_nodes) - head < WIDTH * HEIGHT:
+            wires.append(Wire(out_nodes[head], relay.signal_in2))
+            head += 1
+            out_nodes.extend(relay.signal_out2)
+        relays.append(relay)
+
+    grid = [(x, y) for y in range(HEIGHT) for x in range(WIDTH)]
+    grid_in = out_nodes[head:head + FRAME_SIZE]
+
+    regexs.extend(RegEx(x, y) for x, y in grid)
+    lights.extend(Light(x, y) for x, y in grid)
+    wires.extend(
+        wire
+        for node, regex, light in zip(grid_in, regexs, lights)
+        for wire in (Wire(node, regex.signal_in),
+                     Wire(regex.signal_out, light.set_color)))
+
+    for i, comp in enumerate(itertools.chain(relays, regexs, lights),
+                             COMPONENT_ID_OFFSET):
+        comp.id = i
+
+    offset_id = COMPONENT_ID_OFFSET + len(relays) + len(regexs) + len(lights)
+    for i, wire in enumerate(wires, offset_id):
+        wire.id = i
+        wire.node_start.wire_id = wire.node_end.wire_id = i
+
+    template['concat_length'] = \
+        template['frame_length'] + template['px_lib_length']
+    template['concat_out'] = concat.template()
+    template['relay_comp'] = [relay.template() for relay in relays]
+    template['regex_comp'] = [regex.template() for regex in regexs]
+    template['light_comp'] = [light.template() for light in lights]
+    template['wire'] = [wire.template() for wire in wires]
+
+    print('> Writing item assembly')
     with open(ITEM_ASSEMBLY_TEMPLATE, 'r') as f_template:
-        f_out.write(chevron.render(f_template, template))
+        template_tokens = list(chevron.tokenizer.tokenize(f_template.read()))
+
+    streamed = {
+        key: template[key] for key in STREAMED_FIELDS if key in template}
+    rendered = chevron.render(
+        template_tokens,
+        dict(template, **{key: f'\0{key}\0' for key in streamed}))
+    # NUL marks the streamed placeholders, nothing else may render one
+    assert rendered.count('\0') == 2 * len(streamed)
+
+    output_path = 'build/%s.xml' % template['filename']
+    if COMPRESS_OUTPUT:
+        f_out = gzip.open(output_path + '.gz', 'wt', compresslevel=3)
+    else:
+        f_out = open(output_path, 'w')
+
+    with f_out:
+        for i, part in enumerate(rendered.split('\0')):
+            if i % 2 == 0:
+                f_out.write(part)
+                continue
+            value = streamed[part]
+            # ALPHABET excludes RESERVED_XML_CHARS, so only the '&' end
+            # marker needs escaping
+            f_out.flush()
+            for start in range(0, len(value), WRITE_CHUNK_SIZE):
+                f_out.buffer.write(value[start:start + WRITE_CHUNK_SIZE]
+                                   .replace(b'&', b'&amp;'))
+
+    print('> Waiting for proof encode')
+    if proof_proc.wait():
+        raise ffmpeg.Error('ffmpeg', None, None)
+except BaseException:
+    proof_proc.kill()
+    raise
 
 print('> Done')